@@ -1,172 +1,599 @@
+import array
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Number of entries in the dense multiply accumulator, sized to stay in L2 (512 KB of
+# int64); wider products are computed one column tile of this width at a time
+_ACCUMULATOR_SIZE = 1 << 16
+
+# Rows of a product are computed in blocks of about this many scalar products each
+_BLOCK_PRODUCTS = 1 << 18
+
+# Number of entries formatted per write in save_to_file
+_SAVE_CHUNK = 1 << 16
+
+# Magnitude from which values no longer fit in int64
+_INT64_LIMIT = 1 << 63
+
+# Magnitude from which float64 no longer holds every integer exactly
+_FLOAT64_EXACT_LIMIT = 1 << 53
+
+# Types used for stored values, narrowest first
+_VALUE_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+# Blanks within a line carry no meaning in an entry
+_BLANKS = b' \t\r\f\v'
+
+# Parentheses and commas become blanks so the entries read as a flat list of integers
+_ENTRY_SEPARATORS = bytes.maketrans(b'(),', b'   ')
+
+
 class SparseMatrix:
     def __init__(self, numRows=None, numCols=None, filePath=None):
      
         self.rows = 0
         self.cols = 0
-        self.matrix = {}  # Dictionary of dictionaries: {row: {col: value}}
+        # CSR storage: the columns of row i are indices[indptr[i]:indptr[i+1]]
+        # (sorted ascending) and their values are the same slice of data. data uses
+        # the narrowest signed integer type that holds its values; arithmetic on it
+        # is always done in int64
+        self.data = np.empty(0, dtype=np.int64)
+        self.indices = np.empty(0, dtype=np.int32)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        # Row-major linear index of each stored entry, built on demand and dropped
+        # whenever the sparsity structure changes
+        self._linear_keys = None
+        # Whether every stored entry is on the diagonal, cached like _linear_keys
+        self._diagonal = None
+        # setElement writes that add or remove entries, keyed by (row, col); they are
+        # merged into the CSR arrays in one pass before the next operation
+        self._pending = {}
         
         if filePath is not None:
             self._load_from_file(filePath)
         elif numRows is not None and numCols is not None:
             self.rows = numRows
             self.cols = numCols
+            self.indptr = np.zeros(numRows + 1, dtype=np.int64)
         else:
             raise ValueError("Must provide either dimensions or file path")
     
     def _load_from_file(self, filePath):
         """Load matrix data from file with custom parsing"""
         try:
-            with open(filePath, 'r') as f:
-                lines = [line.strip() for line in f if line.strip() != '']
+            with open(filePath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Parse dimensions from the first two non-empty lines
+                header = []
+                while len(header) < 2:
+                    line = mm.readline()
+                    if not line:
+                        break
+                    if line.strip() != b'':
+                        header.append(line.strip().decode())
                 
-                # Parse dimensions
-                if not lines[0].startswith('rows=') or not lines[1].startswith('cols='):
+                if len(header) < 2 or not header[0].startswith('rows=') or not header[1].startswith('cols='):
                     raise ValueError("Invalid file format - missing dimensions")
                 
-                self.rows = int(lines[0][5:])
-                self.cols = int(lines[1][5:])
+                self.rows = int(header[0][5:])
+                self.cols = int(header[1][5:])
                 
-                # Parse matrix entries
-                for line in lines[2:]:
-                    # Remove all whitespace
-                    line = ''.join(line.split())
-                    
-                    
-                    if not (line.startswith('(') and line.endswith(')')):
-                        raise ValueError(f"Invalid entry format: {line}")
-                    
-                    
-                    content = line[1:-1].split(',')
-                    if len(content) != 3:
-                        raise ValueError(f"Invalid entry format: {line}")
-                    
-                    # Parse values
-                    try:
-                        row = int(content[0])
-                        col = int(content[1])
-                        value = int(content[2])
-                    except ValueError:
-                        raise ValueError(f"Non-integer value in entry: {line}")
-                    
-                    # Validate indices
-                    if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
-                        raise ValueError(f"Index out of bounds in entry: {line}")
-                    
-                    # Store non-zero values
-                    if value != 0:
-                        if row not in self.matrix:
-                            self.matrix[row] = {}
-                        self.matrix[row][col] = value
+                body = mm[mm.tell():]
+            
+            # Check the shape of every entry line at once, then parse all of them in one
+            # pass over the raw bytes
+            compact = body.translate(None, _BLANKS)
+            num_entries = _count_entry_lines(compact)
+            numbers = None
+            if num_entries is not None:
+                try:
+                    numbers = np.fromstring(compact.translate(_ENTRY_SEPARATORS), dtype=np.int64, sep=' ')
+                except ValueError:
+                    pass
+            
+            limits = np.iinfo(np.int64)
+            if (numbers is None or len(numbers) != 3 * num_entries
+                    or (num_entries and (numbers.max() == limits.max or numbers.min() == limits.min))):
+                # Something is off (or a value may not fit); parse line by line so that a
+                # bad entry is reported exactly
+                entries = array.array('q')
+                for line in body.decode().splitlines():
+                    if line.strip() != '':
+                        entries.extend(self._parse_entry(line))
+                numbers = np.frombuffer(entries, dtype=np.int64)
+            
+            rows, cols, values = numbers.reshape(-1, 3).T
+            
+            # Validate indices
+            bad = (rows < 0) | (rows >= self.rows) | (cols < 0) | (cols >= self.cols)
+            if bad.any():
+                n = np.flatnonzero(bad)[0]
+                raise ValueError(f"Index out of bounds in entry: ({rows[n]},{cols[n]},{values[n]})")
+            
+            self._build_csr(rows, cols, values)
                         
         except IOError as e:
             raise IOError(f"Error reading file: {e}")
+        except OverflowError:
+            raise
         except Exception as e:
             raise ValueError(f"Invalid file format: {e}")
     
+    def _parse_entry(self, line):
+        """Parse one "(row, col, value)" line, raising ValueError on a bad entry"""
+        # Remove all whitespace
+        line = ''.join(line.split())
+        
+        
+        if not (line.startswith('(') and line.endswith(')')):
+            raise ValueError(f"Invalid entry format: {line}")
+        
+        
+        content = line[1:-1].split(',')
+        if len(content) != 3:
+            raise ValueError(f"Invalid entry format: {line}")
+        
+        # Parse values
+        try:
+            row = int(content[0])
+            col = int(content[1])
+            value = int(content[2])
+        except ValueError:
+            raise ValueError(f"Non-integer value in entry: {line}")
+        
+        # Validate indices
+        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+            raise ValueError(f"Index out of bounds in entry: {line}")
+        
+        return row, col, value
+    
+    def _build_csr(self, rows, cols, values):
+        """Build the CSR arrays from COO triplets, summing duplicate entries"""
+        keys, values = _reduce_sorted(rows * self.cols + cols, values.astype(np.int64))
+        self._set_from_keys(keys, values)
+    
+    def _find(self, currRow, currCol):
+        """Return the storage position of (currRow, currCol) and whether it is stored"""
+        start, end = self.indptr[currRow], self.indptr[currRow + 1]
+        pos = start + np.searchsorted(self.indices[start:end], currCol)
+        return pos, pos < end and self.indices[pos] == currCol
+    
     def getElement(self, currRow, currCol):
         """Get element at (currRow, currCol)"""
         if currRow < 0 or currRow >= self.rows or currCol < 0 or currCol >= self.cols:
             raise IndexError("Index out of bounds")
         
-        return self.matrix.get(currRow, {}).get(currCol, 0)
+        if self._pending:
+            value = self._pending.get((currRow, currCol))
+            if value is not None:
+                return value
+        
+        pos, found = self._find(currRow, currCol)
+        return int(self.data[pos]) if found else 0
     
     def setElement(self, currRow, currCol, value):
         """Set element at (currRow, currCol) to value"""
         if currRow < 0 or currRow >= self.rows or currCol < 0 or currCol >= self.cols:
             raise IndexError("Index out of bounds")
         
-        if value == 0:
-            
-            if currRow in self.matrix and currCol in self.matrix[currRow]:
-                del self.matrix[currRow][currCol]
-                if not self.matrix[currRow]:  
-                    del self.matrix[currRow]
+        # Convert once so buffered and stored writes read back the same integer
+        value = int(value)
+        value_dtype = _value_dtype(value, value)
+        
+        pos, found = self._find(currRow, currCol)
+        if found and value != 0:
+            # Widen the stored type if the new value does not fit
+            self.data = self.data.astype(np.promote_types(self.data.dtype, value_dtype), copy=False)
+            self.data[pos] = value
+            self._pending.pop((currRow, currCol), None)
         else:
-            if currRow not in self.matrix:
-                self.matrix[currRow] = {}
-            self.matrix[currRow][currCol] = value
+            # Inserting or deleting would shift the arrays; buffer it for _flush instead
+            self._pending[(currRow, currCol)] = value
+    
+    def _flush(self):
+        """Merge pending setElement writes into the CSR arrays"""
+        if not self._pending:
+            return
+        
+        count = len(self._pending)
+        keys = np.fromiter((row * self.cols + col for row, col in self._pending), dtype=np.int64, count=count)
+        values = np.fromiter(self._pending.values(), dtype=np.int64, count=count)
+        self._pending = {}
+        
+        order = np.argsort(keys)
+        keys, values = _merge(self._keys(), self.data, keys[order], values[order], _overwrite)
+        self._set_from_keys(keys, values)
+    
+    def _keys(self):
+        """Return the row-major linear index of every stored entry, in storage order"""
+        if self._linear_keys is None:
+            self._linear_keys = _row_ids(self.indptr) * self.cols + self.indices
+        return self._linear_keys
+    
+    @classmethod
+    def _from_csr(cls, num_rows, num_cols, data, indices, indptr):
+        """Wrap ready-made CSR arrays in a matrix, skipping __init__'s empty allocations"""
+        matrix = cls.__new__(cls)
+        matrix.rows = num_rows
+        matrix.cols = num_cols
+        matrix.data = data
+        matrix.indices = indices
+        matrix.indptr = indptr
+        matrix._linear_keys = None
+        matrix._diagonal = None
+        matrix._pending = {}
+        return matrix
+    
+    def _set_from_keys(self, keys, values):
+        """Fill the CSR arrays from sorted, unique linear indices and their values"""
+        self.data, self.indices, self.indptr = _csr_from_keys(self.rows, self.cols, keys, values)
+        self._linear_keys = None
+        self._diagonal = None
+    
+    def _is_diagonal(self):
+        """Return whether every stored entry lies on the main diagonal"""
+        if self._diagonal is None:
+            # Entry (i, i) has linear index i * (cols + 1); the bound rules out rows past
+            # the last column, whose indices can also be multiples of cols + 1
+            keys = self._keys()
+            stride = self.cols + 1
+            self._diagonal = bool(np.all((keys % stride == 0) & (keys < stride * self.cols)))
+        return self._diagonal
+    
+    def _combine(self, other, op):
+        """Return op(self, other) elementwise as a single merge over both sets of entries"""
+        self._flush()
+        other._flush()
+        exact = _max_abs(self.data) + _max_abs(other.data) >= _INT64_LIMIT
+        keys, values = _merge(self._keys(), self.data, other._keys(), other.data, op, exact)
+        return SparseMatrix._from_csr(self.rows, self.cols, *_csr_from_keys(self.rows, self.cols, keys, values))
     
     def add(self, other):
         """Add another matrix to this matrix"""
         if self.rows != other.rows or self.cols != other.cols:
             raise ValueError("Matrix dimensions must match for addition")
         
-        result = SparseMatrix(self.rows, self.cols)
-        
-        # Copy all elements from self
-        for row in self.matrix:
-            for col in self.matrix[row]:
-                result.setElement(row, col, self.getElement(row, col))
-        
-        # Add elements from other matrix
-        for row in other.matrix:
-            for col in other.matrix[row]:
-                current = result.getElement(row, col)
-                result.setElement(row, col, current + other.getElement(row, col))
-        
-        return result
+        return self._combine(other, np.add)
     
     def subtract(self, other):
         """Subtract another matrix from this matrix"""
         if self.rows != other.rows or self.cols != other.cols:
             raise ValueError("Matrix dimensions must match for subtraction")
         
-        result = SparseMatrix(self.rows, self.cols)
+        return self._combine(other, np.subtract)
+    
+    def multiply(self, other, backend=None):
+        """Multiply this matrix with another matrix
+        
+        backend='cupy' runs the product on the GPU with cuSPARSE; see _multiply_cupy.
+        Products whose partial sums may reach 2**53 are computed on the CPU instead, as
+        the GPU works in float64.
+        """
+        if self.cols != other.rows:
+            raise ValueError("Number of columns in first matrix must match number of rows in second matrix")
+        
+        self._flush()
+        other._flush()
+        
+        # Each result entry sums at most min(longest row of self, longest column of other)
+        # products, which bounds every partial sum the int64 arithmetic below can reach;
+        # past 2**63 the sums are checked exactly instead
+        terms = min(int(np.diff(self.indptr).max(initial=0)), int(np.bincount(other.indices).max(initial=0)))
+        bound = _max_abs(self.data) * _max_abs(other.data) * terms
+        exact = bound >= _INT64_LIMIT
+        
+        if backend == 'cupy':
+            if bound < _FLOAT64_EXACT_LIMIT:
+                return self._multiply_cupy(other)
+        elif backend is not None:
+            raise ValueError(f"Unknown backend: {backend}")
+        
+        # A diagonal operand just scales the columns or rows of the other one
+        if other._is_diagonal():
+            return _scale_by_diagonal(self, other, self.rows, other.cols, False, exact)
+        if self._is_diagonal():
+            return _scale_by_diagonal(other, self, self.rows, other.cols, True, exact)
         
-        # Copy all elements from self
-        for row in self.matrix:
-            for col in self.matrix[row]:
-                result.setElement(row, col, self.getElement(row, col))
+        # Split the rows into blocks of similar work, counted in scalar products, so that
+        # short rows are handled many at a time
+        products = np.zeros(len(self.indices) + 1, dtype=np.int64)
+        np.cumsum(np.diff(other.indptr)[self.indices], out=products[1:])
+        row_products = products[self.indptr]
+        targets = np.arange(0, row_products[-1], _BLOCK_PRODUCTS)
+        starts = np.union1d([0], np.searchsorted(row_products, targets, side='right') - 1).tolist()
+        stops = starts[1:] + [self.rows]
         
-        # Subtract elements from other matrix
-        for row in other.matrix:
-            for col in other.matrix[row]:
-                current = result.getElement(row, col)
-                result.setElement(row, col, current - other.getElement(row, col))
+        # Each thread reuses its own dense accumulator
+        scratch = threading.local()
         
-        return result
+        def compute_block(start, stop):
+            if not hasattr(scratch, 'accumulator'):
+                scratch.accumulator = np.zeros(_ACCUMULATOR_SIZE, dtype=np.int64)
+            block_keys, block_values = _spgemm_rows(self, other, start, stop, scratch.accumulator, exact)
+            return block_keys + start * other.cols, block_values
+        
+        workers = min(os.cpu_count() or 1, len(starts))
+        if workers > 1:
+            # Blocks own disjoint rows, so results are simply concatenated in order
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                blocks = list(pool.map(compute_block, starts, stops))
+        else:
+            blocks = [compute_block(start, stop) for start, stop in zip(starts, stops)]
+        
+        keys, values = zip(*blocks)
+        keys, values = np.concatenate(keys), np.concatenate(values)
+        return SparseMatrix._from_csr(self.rows, other.cols, *_csr_from_keys(self.rows, other.cols, keys, values))
     
-    def multiply(self, other):
-        """Multiply this matrix with another matrix"""
-        if self.cols != other.rows:
-            raise ValueError("Number of columns in first matrix must match number of rows in second matrix")
+    def _multiply_cupy(self, other):
+        """Multiply on the GPU with CuPy's cuSPARSE SpGEMM
+        
+        Both matrices are copied over PCIe and the product copied back, so this only pays
+        off for large products. cuSPARSE has no integer SpGEMM, so the product is computed
+        in float64 and is exact only while every partial sum stays below 2**53, which
+        multiply checks before calling this.
+        """
+        try:
+            import cupy as cp
+            import cupyx.scipy.sparse as cpsp
+        except ImportError:
+            raise ImportError("The cupy backend requires CuPy to be installed")
         
-        result = SparseMatrix(self.rows, other.cols)
-        
-        # Precompute transpose of other matrix for efficient column access
-        other_transpose = {}
-        for row in other.matrix:
-            for col in other.matrix[row]:
-                if col not in other_transpose:
-                    other_transpose[col] = {}
-                other_transpose[col][row] = other.matrix[row][col]
-        
-        # Perform multiplication
-        for i in self.matrix:
-            for k in other_transpose:
-                dot_product = 0
-                # Compute dot product of row i of self and column k of other
-                for j in self.matrix[i]:
-                    if j in other_transpose[k]:
-                        dot_product += self.matrix[i][j] * other_transpose[k][j]
-                if dot_product != 0:
-                    result.setElement(i, k, dot_product)
-        
-        return result
+        a = cpsp.csr_matrix((cp.asarray(self.data, dtype=cp.float64), cp.asarray(self.indices),
+                             cp.asarray(self.indptr)), shape=(self.rows, self.cols))
+        b = cpsp.csr_matrix((cp.asarray(other.data, dtype=cp.float64), cp.asarray(other.indices),
+                             cp.asarray(other.indptr)), shape=(other.rows, other.cols))
+        product = a @ b
+        
+        rows = _row_ids(product.indptr.get())
+        keys, values = _reduce_sorted(rows * other.cols + product.indices.get(),
+                                      np.rint(product.data.get()).astype(np.int64))
+        return SparseMatrix._from_csr(self.rows, other.cols, *_csr_from_keys(self.rows, other.cols, keys, values))
     
     def save_to_file(self, filePath):
        
+        self._flush()
         with open(filePath, 'w') as f:
             f.write(f"rows={self.rows}\n")
             f.write(f"cols={self.cols}\n")
             
-            # Get all non-zero entries sorted by row and column
-            entries = []
-            for row in sorted(self.matrix.keys()):
-                for col in sorted(self.matrix[row].keys()):
-                    entries.append(f"({row},{col},{self.matrix[row][col]})\n")
-            
-            f.writelines(entries)
+            # CSR entries are already sorted by row and column. printf-style formatting
+            # beats both f-strings and np.savetxt (which formats row by row in Python);
+            # writing in chunks bounds the size of each joined string
+            rows = _row_ids(self.indptr)
+            for start in range(0, len(self.data), _SAVE_CHUNK):
+                stop = start + _SAVE_CHUNK
+                entries = zip(rows[start:stop].tolist(), self.indices[start:stop].tolist(),
+                              self.data[start:stop].tolist())
+                f.write(''.join(map("(%d,%d,%d)\n".__mod__, entries)))
+
+def _csr_from_keys(num_rows, num_cols, keys, values):
+    """Return CSR (data, indices, indptr) for sorted, unique linear indices and their
+    values; zero values are dropped
+    """
+    nonzero = values != 0
+    keys, values = keys[nonzero], values[nonzero]
+    rows, cols = np.divmod(keys, num_cols)
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return _narrow(values), cols.astype(np.int32), indptr
+
+
+def _row_ids(indptr):
+    """Return the row of every entry covered by indptr, counting from 0"""
+    return np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+
+
+def _scale_by_diagonal(operand, diagonal, num_rows, num_cols, on_rows, exact):
+    """Return the num_rows x num_cols product of operand and a diagonal matrix, which
+    scales the rows of operand when on the left (on_rows) and its columns otherwise;
+    exact computes the products on Python ints and checks that they fit in int64
+    """
+    scale = np.zeros(operand.rows if on_rows else operand.cols, dtype=np.int64)
+    scale[diagonal.indices] = diagonal.data
+    rows = _row_ids(operand.indptr)
+    keys = rows * num_cols + operand.indices
+    factors = scale[rows if on_rows else operand.indices]
+    if exact:
+        values = _to_int64(operand.data.astype(object) * factors.astype(object))
+    else:
+        values = operand.data * factors
+    return SparseMatrix._from_csr(num_rows, num_cols, *_csr_from_keys(num_rows, num_cols, keys, values))
+
+
+def _merge(a_keys, a_values, b_keys, b_values, op, exact=False):
+    """Merge two sorted sets of linear keys, applying op where b has an entry
+    
+    Returns the sorted union of the keys and, for each, op(a value or 0, b value) where
+    b has the key and the a value otherwise. exact applies op on Python ints and raises
+    OverflowError if a result does not fit in int64.
+    """
+    # A stable sort of two sorted runs is a linear merge. Keys are unique within each
+    # run, so a key shared by both shows up as an a entry directly followed by a b entry
+    keys = np.concatenate((a_keys, b_keys))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = np.concatenate((a_values, b_values), dtype=np.int64)[order]
+    shared = np.zeros(len(keys), dtype=bool)
+    shared[1:] = keys[1:] == keys[:-1]
+    
+    # Combine every b entry with its a partner, or with zero if it has none, in one pass
+    lone = (order >= len(a_keys)) & ~shared
+    pos = np.flatnonzero(shared)
+    if exact:
+        values[lone] = _to_int64(op(0, values[lone].astype(object)))
+        values[pos] = _to_int64(op(values[pos - 1].astype(object), values[pos].astype(object)))
+    else:
+        values[lone] = op(0, values[lone])
+        values[pos] = op(values[pos - 1], values[pos])
+    
+    # Keep the last entry of each key, which holds the combined value
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = ~shared[1:]
+    return keys[last], values[last]
+
+
+def _overwrite(old, new):
+    """Merge op that keeps the new value"""
+    return new
+
+
+def _spgemm_rows(a, b, start, stop, accumulator, exact=False):
+    """Compute rows [start, stop) of a @ b with Gustavson's row-wise algorithm
+    
+    Returns the sorted linear indices (relative to row start) and values of the
+    block's nonzeros. The accumulator must be all zeros and is left that way. exact
+    means the int64 sums may wrap; the block is then rechecked against its own bound
+    and, if that is too large as well, summed on Python ints.
+    """
+    lo, hi = a.indptr[start], a.indptr[stop]
+    a_rows = _row_ids(a.indptr[start:stop + 1])
+    a_cols = a.indices[lo:hi]
+    a_values = a.data[lo:hi].astype(np.int64)
+    
+    # Every a[i, j] is multiplied with each entry of row j of b
+    counts = b.indptr[a_cols + 1] - b.indptr[a_cols]
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    
+    width = int(counts[0])
+    if counts.min() == counts.max():
+        # Every row of b involved has the same length (typical inside a band), so the
+        # products form a fixed-width (nnz, width) tile laid out by broadcasting alone
+        b_pos = (b.indptr[a_cols][:, None] + np.arange(width)).ravel()
+        rows = np.repeat(a_rows, width)
+        products = (a_values[:, None] * b.data[b_pos].reshape(-1, width)).ravel()
+    else:
+        group_start = np.repeat(np.cumsum(counts) - counts, counts)
+        b_pos = np.arange(total) - group_start + np.repeat(b.indptr[a_cols], counts)
+        rows = np.repeat(a_rows, counts)
+        products = np.repeat(a_values, counts) * b.data[b_pos]
+    cols = b.indices[b_pos].astype(np.int64)
+    
+    if exact:
+        b_values = b.data[b_pos]
+        block_terms = int(np.diff(a.indptr[start:stop + 1]).max())
+        if _max_abs(a_values) * _max_abs(b_values) * block_terms >= _INT64_LIMIT:
+            products = np.repeat(a_values.astype(object), counts) * b_values.astype(object)
+            return _reduce_sorted(rows * b.cols + cols, products)
+    
+    num_rows = stop - start
+    if total * np.log2(total + 1) < num_rows * b.cols or num_rows > len(accumulator):
+        # Few products for the column range: sorting them is cheaper than a dense scan
+        return _reduce_sorted(rows * b.cols + cols, products)
+    
+    tile = min(b.cols, len(accumulator) // num_rows)
+    if tile == b.cols:
+        return _reduce_dense(rows * b.cols + cols, products, num_rows * b.cols, accumulator)
+    
+    # Group the products by column tile so each tile's accumulator stays cache-resident
+    num_tiles = -(-b.cols // tile)
+    tile_ids = cols // tile
+    order = np.argsort(tile_ids, kind='stable')
+    bounds = np.searchsorted(tile_ids[order], np.arange(num_tiles + 1))
+    keys, values = [], []
+    for t in range(num_tiles):
+        sel = order[bounds[t]:bounds[t + 1]]
+        if len(sel) == 0:
+            continue
+        k0 = t * tile
+        width = min(tile, b.cols - k0)
+        tile_keys, tile_values = _reduce_dense(rows[sel] * width + cols[sel] - k0, products[sel],
+                                               num_rows * width, accumulator)
+        tile_rows, tile_cols = np.divmod(tile_keys, width)
+        keys.append(tile_rows * b.cols + tile_cols + k0)
+        values.append(tile_values)
+    
+    # Interleave the per-tile outputs back into row-major order
+    keys, values = np.concatenate(keys), np.concatenate(values)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], values[order]
+
+
+def _reduce_sorted(keys, products):
+    """Sum products sharing a key by sorting them, returning sorted keys and their sums
+    
+    products may be int64 or Python ints; the sums are int64 either way, and
+    OverflowError is raised if one does not fit.
+    """
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    products = products[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    
+    # A run of k products of magnitude at most m sums to at most k * m; only when that
+    # could reach 2**63 are the runs summed on Python ints and checked
+    longest = int(np.diff(starts, append=len(keys)).max(initial=0))
+    if _max_abs(products) * longest >= _INT64_LIMIT:
+        return keys[starts], _to_int64(np.add.reduceat(products.astype(object), starts))
+    return keys[starts], np.add.reduceat(products, starts).astype(np.int64, copy=False)
+
+
+def _reduce_dense(keys, products, span, accumulator):
+    """Sum products sharing a key in [0, span) in the dense accumulator"""
+    # Scatter, gather the nonzeros, then clear only what was touched
+    np.add.at(accumulator, keys, products)
+    keys = np.flatnonzero(accumulator[:span])
+    values = accumulator[keys]
+    accumulator[keys] = 0
+    return keys, values
+
+
+def _count_entry_lines(compact):
+    """Return the number of non-empty lines in compact, or None if any of them is not
+    shaped like "(a,b,c)"; compact must have its blanks removed
+    """
+    chars = np.frombuffer(compact, dtype=np.uint8)
+    newlines = np.flatnonzero(chars == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(chars)]))
+    used = ends > starts
+    
+    # Each line opens and closes with a parenthesis and holds two commas; with exactly one
+    # parenthesis of each kind per line, there is nothing else around or between entries
+    commas = np.bincount(np.searchsorted(newlines, np.flatnonzero(chars == ord(','))),
+                         minlength=len(starts))
+    num_lines = int(used.sum())
+    ok = (np.all(chars[starts[used]] == ord('(')) and np.all(chars[ends[used] - 1] == ord(')'))
+          and np.all(commas[used] == 2) and compact.count(b'(') == num_lines
+          and compact.count(b')') == num_lines)
+    return num_lines if ok else None
+
+
+def _max_abs(values):
+    """Return the largest magnitude in values as a Python int, 0 if there are none"""
+    if len(values) == 0:
+        return 0
+    return max(-int(values.min()), int(values.max()))
+
+
+def _to_int64(values):
+    """Return values (Python ints) as int64, raising OverflowError if any does not fit"""
+    if len(values) and (values.min() < -_INT64_LIMIT or values.max() >= _INT64_LIMIT):
+        raise OverflowError("Result does not fit in a 64-bit integer")
+    return values.astype(np.int64)
+
+
+def _value_dtype(low, high):
+    """Return the narrowest signed integer type holding every value in [low, high]"""
+    for dtype in _VALUE_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    raise OverflowError("Value does not fit in a 64-bit integer")
+
+
+def _narrow(values):
+    """Return values cast to the narrowest signed integer type that holds them"""
+    if len(values) == 0:
+        return values.astype(np.int64)
+    return values.astype(_value_dtype(values.min(), values.max()))
+
 
 def main():
     print("Sparse Matrix Operations")